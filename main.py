@@ -2,18 +2,18 @@ import os
 from typing import List
 
 from dotenv import load_dotenv
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_core.output_parsers import PydanticToolsParser
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
 from pydantic import ValidationError
-from starlette.config import undefined
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.cors import CORSMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from model import AiAnalysis, ConversationMessage, ConversationState, EnhancedOrderInitiation, \
-    order_schema
+    ORDER_SCHEMA_JSON, parse_order
 
 if os.getenv("ENVIRONNEMENT") == "PROD":
     load_dotenv("config/.env")
@@ -21,18 +21,33 @@ else:
     load_dotenv()
 
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
-from tool import chat_gpt_4o, chat_gpt_4
+from tool import chat_gpt_4o
 
 
-# Middleware to disable caching
-class NoCacheMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0, post-check=0, pre-check=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        return response
+# Middleware to disable caching, plain ASGI so the headers are appended to the raw response start message
+class NoCacheMiddleware:
+    headers = [
+        (b"cache-control", b"no-store, no-cache, must-revalidate, max-age=0, post-check=0, pre-check=0"),
+        (b"pragma", b"no-cache"),
+        (b"expires", b"0"),
+    ]
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *self.headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
 
 
 app = FastAPI(
@@ -40,6 +55,7 @@ app = FastAPI(
     description="First version API SORB with AI",
     version="v0",
     openapi_url="/openapi.json",
+    default_response_class=ORJSONResponse,
 )
 
 # CORS origins allowed
@@ -48,7 +64,8 @@ origins = ["*"]
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_credentials=True,
+    # Credentials can't be combined with a wildcard origin, the API doesn't rely on them
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -57,142 +74,184 @@ app.add_middleware(
 app.add_middleware(NoCacheMiddleware)
 
 
-def categorize_order(state: ConversationState):
+MAX_HISTORY_MESSAGES = 6
+
+
+async def categorize_order(state: ConversationState):
     conversation_messages: List[ConversationMessage] = state["conversation_messages"]
 
+    # Orders only depend on the latest exchanges: keep the conversation's system context and at most
+    # MAX_HISTORY_MESSAGES other messages, starting on a Human message so no AI reply loses its question
+    if len(conversation_messages) > MAX_HISTORY_MESSAGES:
+        system_messages = [message for message in conversation_messages if message.data_type == "System"]
+        recent_messages = [message for message in conversation_messages if message.data_type != "System"]
+        recent_messages = recent_messages[-MAX_HISTORY_MESSAGES:]
+        first_human = next((i for i, message in enumerate(recent_messages) if message.data_type == "Human"), 0)
+        conversation_messages = system_messages + recent_messages[first_human:]
+
     messages = []
     for message in conversation_messages:
-        if message.data_type == "AI":
-            if message.payload is not undefined:
+        if message.data_type == "Human":
+            messages.append(HumanMessage(content=message.data))
+        elif message.data_type == "System":
+            messages.append(SystemMessage(content=message.data))
+        else:
+            if message.payload is not None:
                 messages.append(AIMessage(content=message.payload))
-        messages.append(AIMessage(content=message.data))
+            messages.append(AIMessage(content=message.data))
     return {"messages": messages}
 
 
-def create_order(state: ConversationState):
-    system_prompt = (
+PARSED_ORDER_COMMENT = "Thank you for initiating your order. Please check its details and confirm it to proceed."
 
-        """ Populate an OrderInitiation object using AI-human chat interaction, adhering strictly to handling unclear or 
-        incomplete order details without altering the original inputs or using one input for multiple fields. Always 
-        verify and clarify missing information based on the template default and on your educated guesses, and ensure 
-        that each field input complies with the JSON schema requirements including format and length. But NEVER use an 
-        input to complete two different fields (example intervenant and security) in the  order and NEVER truncate or 
-        change an input.
-        
-        Interpret the structure provided to accurately identify and manage missing fields :
-        
-        {order_initiation_class_structure}
 
+async def try_parse_order(state: ConversationState):
+    human_messages = [message for message in state["conversation_messages"] if message.data_type == "Human"]
+    if not human_messages:
+        return {}
 
-        Example Process:
+    order_initiation = parse_order(human_messages[-1].data)
+    if order_initiation is None:
+        return {}
+    return {"order_initiation": AiAnalysis(orderInitiation=order_initiation, comment=PARSED_ORDER_COMMENT)}
 
-        Received User Input: '12334567 2000 50'
-        Analysis: Fields are missing, 1234567 match the intervenant required length. Based on the schema orderClass and
-        OrderType are missing. Use the template default ('N' an 'BUY' and ask the user to provide the security id"
-        Expected response : Thank you for initiating your order. It looks like we're missing some information to 
-        proceed: Could you please provide the intervenant ID and confirm that the other fields are correct? Your 
-        cooperation is greatly appreciated.
-        """
-    )
 
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessagePromptTemplate.from_template(system_prompt),
-            MessagesPlaceholder(variable_name="messages"),
+def route_order(state: ConversationState):
+    # Well-formed orders were already parsed and validated, no need to ask the LLM
+    if state.get("order_initiation") is not None:
+        return "create_response"
+    return "create_order"
+
+
+create_order_system_prompt = (
+
+    """ Populate an OrderInitiation object using AI-human chat interaction, adhering strictly to handling unclear or 
+    incomplete order details without altering the original inputs or using one input for multiple fields. Always 
+    verify and clarify missing information based on the template default and on your educated guesses, and ensure 
+    that each field input complies with the JSON schema requirements including format and length. But NEVER use an 
+    input to complete two different fields (example intervenant and security) in the  order and NEVER truncate or 
+    change an input.
+    
+    Interpret the structure provided to accurately identify and manage missing fields :
+    
+    {order_initiation_class_structure}
+
+
+    Example Process:
+
+    Received User Input: '12334567 2000 50'
+    Analysis: Fields are missing, 1234567 match the intervenant required length. Based on the schema orderClass and
+    OrderType are missing. Use the template default ('N' an 'BUY' and ask the user to provide the security id"
+    Expected response : Thank you for initiating your order. It looks like we're missing some information to 
+    proceed: Could you please provide the intervenant ID and confirm that the other fields are correct? Your 
+    cooperation is greatly appreciated.
+    """
+)
+
+# Static instructions first, conversation last: Azure OpenAI caches prompt prefixes automatically as long as the
+# leading bytes are identical between calls, so the system message is rendered once and never re-templated.
+create_order_system_message = SystemMessage(
+    content=create_order_system_prompt.format(order_initiation_class_structure=ORDER_SCHEMA_JSON))
 
-        ]
-    ).partial(order_initiation_class_structure=order_schema)
+create_order_prompt = ChatPromptTemplate.from_messages(
+    [
+        create_order_system_message,
+        MessagesPlaceholder(variable_name="messages"),
+
+    ]
+)
+
+# Built once at import: the chain only depends on the "messages" injected through the placeholder
+CREATE_ORDER_CHAIN = (
+        create_order_prompt | chat_gpt_4o.bind_tools([AiAnalysis],
+                                                     tool_choice="AiAnalysis") | PydanticToolsParser(tools=[AiAnalysis]))
+
+validate_order_system_prompt = (
+
+    """
+     Given a user's initial input related to initiating an order and a list of validation errors 
+    pertaining to missing or incorrect required fields, create a response that politely prompts the user 
+    to address these errors in a functional, non-technical manner. NEVER use variable type (like string, boolean,
+    etc, in your response use the names. Don't ask two times informations for the same field
+    
+    Parameters:
+    - initial_message (str): 
+    {initial_message}
+    
+    - validation_errors :
+    {validation_errors}
+    
+     ) 
+    """
+)
+
+validate_order_prompt = ChatPromptTemplate.from_messages(
+    [
+        SystemMessagePromptTemplate.from_template(validate_order_system_prompt),
+
+    ]
+)
+
+VALIDATE_ORDER_CHAIN = validate_order_prompt | chat_gpt_4o.bind_tools([AIMessage],
+                                                                      tool_choice="AIMessage") | PydanticToolsParser(
+    tools=[AIMessage])
 
-    content_parser_pydantic = PydanticToolsParser(tools=[AiAnalysis])
-    create_content_chain = (
-            prompt | chat_gpt_4.bind_tools([AiAnalysis],
-                                           tool_choice="AiAnalysis") | content_parser_pydantic)
 
-    # create_content_chain = prompt | chat_gpt_4o
-    res = create_content_chain.invoke({"messages": state["messages"]})
+async def create_order(state: ConversationState, config: RunnableConfig):
+    res = await CREATE_ORDER_CHAIN.ainvoke({"messages": state["messages"]}, config)
 
     print(res[0])
     return {"order_initiation": res[0]}
 
 
-def validate_order(state: ConversationState, validate_content_chain=None):
-    system_prompt = (
-
-        """
-         Given a user's initial input related to initiating an order and a list of validation errors 
-        pertaining to missing or incorrect required fields, create a response that politely prompts the user 
-        to address these errors in a functional, non-technical manner. NEVER use variable type (like string, boolean,
-        etc, in your response use the names. Don't ask two times informations for the same field
-        
-        Parameters:
-        - initial_message (str): 
-        {initial_message}
-        
-        - validation_errors :
-        {validation_errors}
-        
-         ) 
-        """
-    )
+async def validate_order(state: ConversationState):
     order: AiAnalysis = state["order_initiation"]
+    if isinstance(order.orderInitiation, EnhancedOrderInitiation):
+        return {"order_initiation": order}
+
     try:
         # Assuming EnhancedOrderInitiation is a pre-defined class similar to OrderInitiation with additional validation
-        enhanced_order = EnhancedOrderInitiation(**order.orderInitiation.model_dump())
-        state["order_initiation"].orderInitiation = enhanced_order
+        order.orderInitiation = EnhancedOrderInitiation.model_validate(order.orderInitiation, from_attributes=True)
     except ValidationError as e:
         print(e)
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                SystemMessagePromptTemplate.from_template(system_prompt),
-
-            ]
-        )
-
-        validate_content_chain = prompt | chat_gpt_4o.bind_tools([AIMessage],
-                                                                 tool_choice="AIMessage") | PydanticToolsParser(
-            tools=[AIMessage])
-
-        res = validate_content_chain.invoke(input={"validation_errors": str(e), "initial_message": order.comment})
+        res = await VALIDATE_ORDER_CHAIN.ainvoke(input={"validation_errors": str(e), "initial_message": order.comment})
 
         order.comment = res[0].content
 
         return {"order_initiation": order}
-    pass
+    return {"order_initiation": order}
 
 
-def create_response(state: ConversationState):
+async def create_response(state: ConversationState):
     conversation = ConversationMessage(
         data_type="AI",
         data=state["order_initiation"].comment,
         payload_type="OrderInitiation",
         payload=state["order_initiation"].orderInitiation.model_dump_json()
     )
-    return {"conversation_messages": state["conversation_messages"] + [conversation]}
+    return {"conversation_messages": [conversation]}
 
 
 workflow = StateGraph(ConversationState)
 
 workflow.add_node("categorize_order", categorize_order)
+workflow.add_node("try_parse_order", try_parse_order)
 workflow.add_node("create_order", create_order)
 workflow.add_node("validate_order", validate_order)
 workflow.add_node("create_response", create_response)
 
 workflow.add_edge(START, "categorize_order")
-workflow.add_edge("categorize_order", "create_order")
+workflow.add_edge("categorize_order", "try_parse_order")
+workflow.add_conditional_edges("try_parse_order", route_order, ["create_order", "create_response"])
 workflow.add_edge("create_order", "validate_order")
 workflow.add_edge("validate_order", "create_response")
 workflow.add_edge("create_response", END)
 graph = workflow.compile()
 
 
-@app.options("/{rest_of_path:path}")
-async def preflight_handler():
-    return
-
-
 @app.post("/orderinitiation/")
 async def load_default_values(message_list: List[ConversationMessage]):
     inputs = {"conversation_messages": message_list}
 
-    result = graph.invoke(inputs)
+    result = await graph.ainvoke(inputs)
     return result["conversation_messages"]
@@ -1,9 +1,23 @@
+import json
+import operator
 import re
 from enum import Enum
-from typing import Literal, Optional, TypedDict, List
+from typing import Annotated, Literal, Optional, TypedDict, List
 
 from langchain_core.messages import BaseMessage
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, StringConstraints, ValidationError
+
+INTERVENANT_PATTERN = r'^[\da-zA-Z]{7}$'
+SECURITY_PATTERN = r'^[\da-zA-Z]{6}\.[\da-zA-Z]{3}$'
+
+# fullmatch() so that, like pydantic-core, "$" doesn't accept a trailing newline
+_INTERVENANT_RE = re.compile(INTERVENANT_PATTERN)
+_SECURITY_RE = re.compile(SECURITY_PATTERN)
+_QUANTITY_RE = re.compile(r'^\d+(\.\d+)?$')
+
+# Checked by pydantic-core itself, without calling back into Python
+IntervenantStr = Annotated[str, StringConstraints(pattern=INTERVENANT_PATTERN)]
+SecurityIdStr = Annotated[str, StringConstraints(pattern=SECURITY_PATTERN)]
 
 
 class OrderType(str, Enum):
@@ -59,6 +73,9 @@ order_schema = {
     "additionalProperties": False
 }
 
+# Compact serialization, computed once for the prompt
+ORDER_SCHEMA_JSON = json.dumps(order_schema, separators=(',', ':'))
+
 
 class OrderInitiation(BaseModel):
     order_confirmed: bool
@@ -86,40 +103,23 @@ class OrderInitiation(BaseModel):
 
 class EnhancedOrderInitiation(OrderInitiation):
     order_confirmed: bool
-    intervenant: str = Field(
+    intervenant: IntervenantStr = Field(
         description="The identifier for the intervening party in the order process (format:7 digits)",
     )
-    security_id: str = Field(
+    security_id: SecurityIdStr = Field(
         description="The id of the financial security (format: 6 digits, dot, 3 digits)",
     )
     orderType: OrderType = Field(
         description="The type of order being placed, can be either BUY or SELL",
     )
     quantity: float = Field(
+        gt=0,
         description="The quantity of the financial security being traded",
     )
     orderClass: OrderClass = Field(
         description="The classification of the order, such as N for normal order or other specific classifications",
     )
 
-    @field_validator('intervenant')
-    def validate_intervenant(cls, intervenant):
-        if not intervenant or not re.match(r'^[\da-zA-Z]{7}$', intervenant):
-            raise ValueError("It seems that the intervenant is missing or incomplete, please correct")
-        return intervenant
-
-    @field_validator('security_id')
-    def validate_security(cls, security_id):
-        if not security_id or not re.match(r"^[\da-zA-Z]{6}\.[\da-zA-Z]{3}$", security_id):
-            raise ValueError("It seems that the security is missing or incomplete, please correct")
-        return security_id
-
-    @field_validator('quantity')
-    def validate_quantity(cls, quantity):
-        if quantity is None or quantity <= 0:
-            raise ValueError("Quantity must be a positive number.")
-        return quantity
-
 
 class AiAnalysis(BaseModel):
     orderInitiation: OrderInitiation = Field(
@@ -137,8 +137,50 @@ class ConversationMessage(BaseModel):
 
 
 class ConversationState(TypedDict):
-    messages: List[BaseMessage]
-    conversation_messages: List[ConversationMessage]
+    # Nodes return only the new messages, LangGraph appends them
+    messages: Annotated[List[BaseMessage], operator.add]
+    conversation_messages: Annotated[List[ConversationMessage], operator.add]
     conversation_type: Literal["FinancialPosition", "OrderInitiation"]
     order_initiation: AiAnalysis
     question: str
+
+
+def parse_order(text: str) -> Optional[EnhancedOrderInitiation]:
+    """Parse a well-formed "intervenant security orderType quantity orderClass" input without the LLM.
+
+    Returns None as soon as a token is unknown, ambiguous or repeated so the caller can fall back to the LLM.
+    """
+    tokens = text.split()
+    if len(tokens) != 5:
+        return None
+
+    fields = {}
+    identifiers = []
+    for token in tokens:
+        if _SECURITY_RE.fullmatch(token):
+            field = "security_id"
+        elif token in (OrderType.buy.value, OrderType.sell.value):
+            field = "orderType"
+        elif token == OrderClass.normal.value:
+            field = "orderClass"
+        elif _INTERVENANT_RE.fullmatch(token) or _QUANTITY_RE.fullmatch(token):
+            identifiers.append(token)
+            continue
+        else:
+            return None
+        if field in fields:
+            return None
+        fields[field] = token
+
+    # A 7 digits token could be either the intervenant or the quantity, never guess which one it is
+    intervenants = [token for token in identifiers if _INTERVENANT_RE.fullmatch(token)]
+    quantities = [token for token in identifiers if not _INTERVENANT_RE.fullmatch(token)]
+    if len(intervenants) != 1 or len(quantities) != 1:
+        return None
+    fields["intervenant"] = intervenants[0]
+    fields["quantity"] = quantities[0]
+
+    try:
+        return EnhancedOrderInitiation(order_confirmed=False, **fields)
+    except ValidationError:
+        return None
@@ -1,13 +1,34 @@
 import os
 
+import httpx
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
 from langchain_openai import AzureChatOpenAI
 
+# Exact-match cache on (prompt, model parameters): replayed conversations don't hit Azure again
+set_llm_cache(InMemoryCache(maxsize=int(os.getenv("LLM_CACHE_MAXSIZE", "1024"))))
+
+# One connection pool shared by both deployments, HTTP/2 multiplexes concurrent calls on the same connection
+_http_limits = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+shared_http_client = httpx.Client(http2=True, timeout=60, limits=_http_limits)
+shared_http_async_client = httpx.AsyncClient(http2=True, timeout=60, limits=_http_limits)
+
 chat_gpt_4o = AzureChatOpenAI(
     openai_api_version=os.environ["AZURE_GPT_4o_API_VERSION"],
     azure_deployment=os.environ["AZURE_GPT_4o_CHAT_DEPLOYMENT_NAME"],
+    http_client=shared_http_client,
+    http_async_client=shared_http_async_client,
+    temperature=0,
+    max_tokens=256,
+    seed=0,
 )
 
 chat_gpt_4 = AzureChatOpenAI(
     openai_api_version=os.environ["AZURE_GPT_4_API_VERSION"],
     azure_deployment=os.environ["AZURE_GPT_4_CHAT_DEPLOYMENT_NAME"],
+    http_client=shared_http_client,
+    http_async_client=shared_http_async_client,
+    temperature=0,
+    max_tokens=256,
+    seed=0,
 )